@@ -1,22 +1,26 @@
 import os
 import sys
-import re
-import praw
+import asyncio
+import asyncpraw
 import configparser
-import smtplib
+import types
+import aiosmtplib
 import schedule
 import time
 import ssl
+import io
+import zipfile
 import logging
 import json
+import hashlib
+import shelve
+from contextlib import asynccontextmanager, AsyncExitStack
 from pathlib import Path
+from operator import attrgetter
 from datetime import datetime
 from bs4 import BeautifulSoup
 from ebooklib import epub
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email import encoders
+from email.message import EmailMessage
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 # Set up logging
@@ -26,13 +30,14 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 config = configparser.ConfigParser()
 config.read('config.ini')
 
-# Authenticate with Reddit
-reddit = praw.Reddit(
-    client_id=config['REDDIT']['client_id'],
-    client_secret=config['REDDIT']['client_secret'],
-    user_agent=config['REDDIT']['user_agent'],
-    username=config['REDDIT']['username'],
-    password=config['REDDIT']['password']
+# Cache the settings as plain attributes so hot paths skip the configparser lookups
+REDDIT = types.SimpleNamespace(**config['REDDIT'])
+EMAIL = types.SimpleNamespace(**config['EMAIL'])
+EMAIL.smtp_port = int(EMAIL.smtp_port)
+SETTINGS = types.SimpleNamespace(
+    bot_enabled=config['SETTINGS'].getboolean('bot_enabled'),
+    # At least one worker, otherwise builds and the summary email would wait forever
+    workers=max(1, config['SETTINGS'].getint('workers', fallback=4))
 )
 
 # Get the authors and their stories from the configuration
@@ -42,162 +47,406 @@ for author, stories in config['STORIES'].items():
 
 subreddit_name = 'hfy'
 
+# Sent-email log lines collected during a run and written out together at the end
+pending_log = []
+
+sent_cache_path = 'sent_cache.json'
+chapter_cache_path = 'chapter_cache'
+
+# Reddit stops returning search results after this many hits
+search_result_cap = 250
+
+# Maximum number of Reddit lookups in flight at once, to stay within the API rate limits
+reddit_concurrency = 5
+
+# Characters that are not allowed in file names
+sanitize_table = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
+
 def sanitize_title(title):
-    return re.sub(r'[<>:"/\\|?*]', '_', title)
+    return title.translate(sanitize_table)
 
 def validate_story(chapter_title, html_content):
     # Check for a minimum length
     if len(html_content) < 100:
-        return False, f"Chapter '{chapter_title}' is too short."
+        return False, f"Chapter '{chapter_title}' is too short.", None
 
     # Check for missing opening or closing tags
-    soup = BeautifulSoup(html_content, 'html.parser')
-    if soup.find_all(lambda tag: tag.name in ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'] and not tag.text.strip()):
-        return False, f"Chapter '{chapter_title}' contains empty tags."
+    soup = BeautifulSoup(html_content, 'lxml')
+    if any(not tag.text.strip() for tag in soup.find_all(['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'])):
+        return False, f"Chapter '{chapter_title}' contains empty tags.", None
 
     # You can add more validation checks as needed
-    return True, ""
-
-def get_chapters(author, story):
-    redditor = reddit.redditor(author)
+    return True, "", soup
+
+def create_reddit():
+    # Authenticate with Reddit. Async PRAW binds its HTTP session to the running
+    # event loop, so a fresh instance is created for every run.
+    return asyncpraw.Reddit(
+        client_id=REDDIT.client_id,
+        client_secret=REDDIT.client_secret,
+        user_agent=REDDIT.user_agent,
+        username=REDDIT.username,
+        password=REDDIT.password
+    )
+
+async def get_author_submissions(reddit, author):
+    sub_lc = subreddit_name.lower()
+    redditor = await reddit.redditor(author)
     submissions = redditor.submissions.new(limit=None)
-    return [submission for submission in submissions if submission.subreddit.display_name.lower() == subreddit_name.lower() and story.lower() in submission.title.lower()]
-
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=60))
-def download_stories():
-    summary = []
-    failed_files = []
-    if config['SETTINGS'].getboolean('bot_enabled'):
-        for author, stories in authors_stories.items():
-            for story in stories:
-                story_dir = os.path.join(os.getcwd(), sanitize_title(story))
-                Path(story_dir).mkdir(parents=True, exist_ok=True)
-
-                epub_book = epub.EpubBook()
-                epub_book.set_title(story)
-                epub_book.set_language('en')
-                epub_book.add_author(author)
-
-                spine = ['nav']
-                toc = []
-
-                chapter_submissions = {}
-
-                # Collect all the chapter submissions in a dictionary
-                for submission in get_chapters(author, story):
-                    # Replace older submission with newer one if titles are the same
-                    if submission.title in chapter_submissions:
-                        if submission.created_utc > chapter_submissions[submission.title].created_utc:
-                            chapter_submissions[submission.title] = submission
-                    else:
-                        chapter_submissions[submission.title] = submission
-
-                # Sort the submissions by submission date (ascending)
-                sorted_submissions = sorted(chapter_submissions.values(), key=lambda x: x.created_utc)
-
-                # Process the chapters in the sorted order
-                for submission in sorted_submissions:
-                    chapter_title = submission.title
-                    sanitized_chapter_title = sanitize_title(chapter_title)
-                    html_content = submission.selftext_html
-
-                    is_valid, validation_message = validate_story(chapter_title, html_content)
-                    if not is_valid:
-                        logging.error(validation_message)
-                        continue
-                    soup = BeautifulSoup(html_content, 'html.parser')
-
-                    chapter = epub.EpubHtml(title=chapter_title, file_name=f'{sanitized_chapter_title}.xhtml')
-                    chapter.content = str(soup)
-                    epub_book.add_item(chapter)
-
-                    toc.append(chapter)
-                    spine.append(chapter)
-
-                epub_book.toc = toc
-                epub_book.spine = spine
-
-                epub_path = os.path.join(story_dir, f'{sanitize_title(story)}.epub')
-                epub.write_epub(epub_path, epub_book)
-
-                # Send the EPUB file via email and delete it
-                try:
-                    send_email(epub_path, story, config['EMAIL']['receiver'])
-                    os.remove(epub_path)
-                    summary.append(f"Successfully processed and sent {story} by {author}")
-                    log_email_sent(story)
-                except Exception as e:
-                    error_message = f"Failed to send and delete EPUB for {story}: {e}"
-                    logging.error(error_message)
-                    send_email(None, f"Error - {story}", config['EMAIL']['error_receiver'], error_message)
-                    summary.append(error_message)
-                    failed_files.append(epub_path)
-
-    summary_email_body = "Summary:\n\n" + "\n".join(summary)
-    send_email(None, "Stories Download Summary", config['EMAIL']['error_receiver'], summary_email_body)
+    return [submission async for submission in submissions if submission.subreddit.display_name.lower() == sub_lc]
+
+async def get_recent_submissions(reddit, author, since_utc):
+    # The author's submissions posted at or after since_utc; usually a single page
+    sub_lc = subreddit_name.lower()
+    redditor = await reddit.redditor(author)
+    recent = []
+    async for submission in redditor.submissions.new(limit=None):
+        if submission.created_utc < since_utc:
+            break
+        if submission.subreddit.display_name.lower() == sub_lc:
+            recent.append(submission)
+    return recent
+
+def get_chapters(submissions, story):
+    story_lc = story.lower()
+    return [submission for submission in submissions if story_lc in submission.title.lower()]
+
+async def search_chapters(reddit, tg, reddit_limit, author_listings, sent_entry, author, story):
+    async with reddit_limit:
+        # Let Reddit search the subreddit for the story instead of paging through the author's whole history
+        subreddit = await reddit.subreddit(subreddit_name)
+        phrase = story.replace('\\', '\\\\').replace('"', '\\"')
+        results = subreddit.search(f'author:{author} title:"{phrase}"', sort='new', limit=None, syntax='lucene')
+        hits = [submission async for submission in results]
+        chapters = get_chapters(hits, story)
+
+        # Search can miss posts through index lag, its result cap or phrase tokenization
+        # ("Deathworld" does not match "Deathworlders 5"). Only trust it for chapters already
+        # sent: it must stay under the cap and still find every one of them. New chapters it
+        # cannot match are picked up from the author's posts since the newest chapter sent.
+        # Otherwise merge in the author's whole history, fetched at most once per author.
+        sent_titles = set(sent_entry['chapters']) if sent_entry else set()
+        if sent_titles and len(hits) < search_result_cap and sent_titles <= {submission.title for submission in chapters}:
+            extra = get_chapters(await get_recent_submissions(reddit, author, sent_entry['newest_utc']), story)
+        else:
+            if author not in author_listings:
+                author_listings[author] = tg.create_task(get_author_submissions(reddit, author))
+            extra = get_chapters(await author_listings[author], story)
+
+        merged = {submission.id: submission for submission in chapters}
+        merged.update((submission.id, submission) for submission in extra)
+        return list(merged.values())
+
+def recompress_epub(epub_data):
+    # ebooklib always deflates at the default level; the chapter HTML is repetitive
+    # and small, so the maximum level shrinks the attachment at little CPU cost.
+    # Each entry keeps its own compression type, so 'mimetype' stays stored.
+    output = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(epub_data)) as source, zipfile.ZipFile(output, 'w') as target:
+        for item in source.infolist():
+            target.writestr(item, source.read(item), compresslevel=9)
+    return output.getvalue()
+
+def chapter_digests(sorted_submissions):
+    # One hash per chapter title over the submission id, title and body, so edits,
+    # renames and reposts all count as changes
+    return {
+        submission.title: hashlib.sha1('\0'.join((submission.id, submission.title, submission.selftext_html or '')).encode()).hexdigest()
+        for submission in sorted_submissions
+    }
+
+async def process_story(author, story, chapters, worker_limit, smtp_pool, sent_cache, chapter_cache):
+    # Keep only the newest submission for each title, placed by its own submission
+    # date (ascending), so a reposted chapter moves to its repost date
+    chapter_submissions = {}
+    for submission in sorted(chapters, key=attrgetter('created_utc'), reverse=True):
+        chapter_submissions.setdefault(submission.title, submission)
+    sorted_submissions = list(reversed(chapter_submissions.values()))
+
+    # Skip the rebuild if nothing changed since the book was last sent
+    cache_key = f'{author}/{story}'
+    digests = chapter_digests(sorted_submissions)
+    if sent_cache.get(cache_key, {}).get('chapters') == digests:
+        return f"No new chapters for {story} by {author}"
+
+    # Only `workers` books are built and held in memory at once, each sent on its own SMTP connection
+    async with worker_limit:
+        # Chapters parsed on earlier runs
+        cached_chapters = {submission.id: chapter_cache[submission.id] for submission in sorted_submissions if submission.id in chapter_cache}
+
+        # Parsing and zipping are CPU-bound, so keep them off the event loop
+        epub_data, parsed_chapters = await asyncio.to_thread(build_epub, author, story, sorted_submissions, cached_chapters)
+        chapter_cache.update(parsed_chapters)
+
+        # Send the EPUB file via email over a pooled SMTP connection
+        server = await smtp_pool.get()
+        try:
+            await send_email(server, epub_data, story, EMAIL.receiver)
+            log_email_sent(story)
+            # Remember when the newest chapter was posted, so later runs know where new ones start
+            sent_cache[cache_key] = {
+                'chapters': digests,
+                'newest_utc': max((submission.created_utc for submission in sorted_submissions), default=0)
+            }
+            save_sent_cache(sent_cache)
+            return f"Successfully processed and sent {story} by {author}"
+        except Exception as e:
+            error_message = f"Failed to send EPUB for {story}: {e}"
+            logging.error(error_message)
+            await send_email(server, None, f"Error - {story}", EMAIL.error_receiver, error_message)
+            return error_message
+        finally:
+            smtp_pool.put(server)
+
+def build_epub(author, story, sorted_submissions, cached_chapters):
+    epub_book = epub.EpubBook()
+    epub_book.set_title(story)
+    epub_book.set_language('en')
+    epub_book.add_author(author)
+
+    spine = ['nav']
+    toc = []
+    parsed_chapters = {}
+
+    # Process the chapters in the sorted order
+    for submission in sorted_submissions:
+        chapter_title = submission.title
+        sanitized_chapter_title = sanitize_title(chapter_title)
+
+        # Reuse the chapter from an earlier run unless the submission was edited since.
+        # A cache hit skips validate_story, so cached chapters are not re-checked
+        # against validation rules added later; delete the chapter_cache files to force that.
+        cached = cached_chapters.get(submission.id)
+        if cached and cached[0] == submission.edited:
+            content = cached[1]
+        else:
+            html_content = submission.selftext_html
+
+            # Reuse the soup parsed during validation
+            is_valid, validation_message, soup = validate_story(chapter_title, html_content)
+            if not is_valid:
+                logging.error(validation_message)
+                continue
+
+            content = str(soup)
+            parsed_chapters[submission.id] = (submission.edited, content)
+
+        chapter = epub.EpubHtml(title=chapter_title, file_name=f'{sanitized_chapter_title}.xhtml')
+        chapter.content = content
+        epub_book.add_item(chapter)
+
+        toc.append(chapter)
+        spine.append(chapter)
+
+    epub_book.toc = toc
+    epub_book.spine = spine
+
+    # Build the EPUB in memory; it only exists to be emailed
+    epub_buffer = io.BytesIO()
+    epub.write_epub(epub_buffer, epub_book)
+    return recompress_epub(epub_buffer.getvalue()), parsed_chapters
+
+async def download_stories():
+    sent_cache = load_sent_cache()
+
+    # Forget stories that are no longer configured
+    configured_keys = {f'{author}/{story}' for author, stories in authors_stories.items() for story in stories}
+    if sent_cache.keys() - configured_keys:
+        sent_cache = {key: entry for key, entry in sent_cache.items() if key in configured_keys}
+        save_sent_cache(sent_cache)
+
+    chapters = {}
+    if SETTINGS.bot_enabled:
+        # Look up every story's chapters concurrently
+        async with create_reddit() as reddit:
+            reddit_limit = asyncio.Semaphore(reddit_concurrency)
+            author_listings = {}
+            async with asyncio.TaskGroup() as tg:
+                tasks = {
+                    (author, story): tg.create_task(search_chapters(
+                        reddit, tg, reddit_limit, author_listings, sent_cache.get(f'{author}/{story}'), author, story
+                    ))
+                    for author, stories in authors_stories.items() for story in stories
+                }
+
+        chapters = {pair: task.result() for pair, task in tasks.items()}
+
+    async with AsyncExitStack() as stack:
+        worker_limit = asyncio.Semaphore(SETTINGS.workers)
+        smtp_pool = SmtpPool(stack, SETTINGS.workers)
+        chapter_cache = await asyncio.to_thread(load_chapter_cache)
+
+        # Build and send the stories concurrently; they are independent of each other
+        try:
+            results = await asyncio.gather(*(
+                process_story(author, story, story_chapters, worker_limit, smtp_pool, sent_cache, chapter_cache)
+                for (author, story), story_chapters in chapters.items()
+            ), return_exceptions=True)
+        finally:
+            flush_email_log()
+
+            # Keep only the chapters still found on Reddit so the cache doesn't grow forever
+            if chapters:
+                current_ids = {submission.id for story_chapters in chapters.values() for submission in story_chapters}
+                await asyncio.to_thread(save_chapter_cache, chapter_cache, current_ids)
+
+        summary = []
+        for (author, story), result in zip(chapters, results):
+            if isinstance(result, Exception):
+                error_message = f"Failed to process {story} by {author}: {result}"
+                logging.error(error_message)
+                result = error_message
+            summary.append(result)
+
+        summary_email_body = "Summary:\n\n" + "\n".join(summary)
+        await send_email(await smtp_pool.get(), None, "Stories Download Summary", EMAIL.error_receiver, summary_email_body)
 
 
 
 def log_email_sent(story_title):
+    pending_log.append(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - {story_title}\n")
+
+def flush_email_log():
+    if not pending_log:
+        return
+
     log_dir = 'email_logs'
     Path(log_dir).mkdir(parents=True, exist_ok=True)
 
     log_date = time.strftime('%Y-%m-%d')
     log_file_path = os.path.join(log_dir, f'{log_date}_email_sent.log')
 
-    with open(log_file_path, 'a') as log_file:
-        log_file.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - {story_title}\n")
+    with open(log_file_path, 'a', buffering=1 << 16) as log_file:
+        log_file.writelines(pending_log)
+        log_file.flush()
+        os.fsync(log_file.fileno())
+    pending_log.clear()
 
     clean_old_logs(log_dir, max_size_mb=25)
 
-def clean_old_logs(log_dir, max_size_mb):
-    log_files = sorted(Path(log_dir).glob('*.log'), key=os.path.getctime)
-    total_size_mb = sum(os.path.getsize(f) for f in log_files) / (1024 * 1024)
+def load_sent_cache():
+    try:
+        with open(sent_cache_path) as cache_file:
+            sent_cache = json.load(cache_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+    # Drop entries left over from older cache formats
+    return {key: entry for key, entry in sent_cache.items() if isinstance(entry, dict) and 'newest_utc' in entry}
+
+def save_sent_cache(sent_cache):
+    # Write to a temporary file first so a crash never leaves a truncated cache
+    tmp_path = f'{sent_cache_path}.tmp'
+    with open(tmp_path, 'w') as cache_file:
+        json.dump(sent_cache, cache_file)
+    os.replace(tmp_path, sent_cache_path)
+
+def load_chapter_cache():
+    with shelve.open(chapter_cache_path) as chapter_cache:
+        return dict(chapter_cache)
+
+def save_chapter_cache(chapter_cache, current_ids):
+    # 'n' starts a fresh file, dropping entries for submissions no longer seen
+    with shelve.open(chapter_cache_path, flag='n') as shelf:
+        shelf.update((submission_id, chapter) for submission_id, chapter in chapter_cache.items() if submission_id in current_ids)
 
-    while total_size_mb > max_size_mb:
-        oldest_log = log_files.pop(0)
+def clean_old_logs(log_dir, max_size_mb):
+    # Stat each log once and keep a running total while deleting the oldest ones
+    log_files = sorted(((f, f.stat()) for f in Path(log_dir).glob('*.log')), key=lambda entry: entry[1].st_ctime)
+    total_size = sum(stat.st_size for _, stat in log_files)
+    max_size = max_size_mb * 1024 * 1024
+
+    for oldest_log, stat in log_files:
+        if total_size <= max_size:
+            break
         os.remove(oldest_log)
-        total_size_mb = sum(os.path.getsize(f) for f in log_files) / (1024 * 1024)
+        total_size -= stat.st_size
+
+async def smtp_connect(server):
+    await server.connect()
+    await server.login(EMAIL.username, EMAIL.password)
+
+@asynccontextmanager
+async def smtp_session():
+    # Keep a single authenticated SMTP connection open for a batch of emails
+    context = ssl.create_default_context()
+    server = aiosmtplib.SMTP(hostname=EMAIL.smtp_server, port=EMAIL.smtp_port, start_tls=True, tls_context=context)
+    try:
+        # Connect inside the try so a failed login still closes the connection
+        await smtp_connect(server)
+        yield server
+    finally:
+        try:
+            await server.quit()
+        except aiosmtplib.SMTPException:
+            server.close()
+
+class SmtpPool:
+    # Opens SMTP connections only when an email needs one, up to `size` of them,
+    # and hands each connection to a single sender at a time
+    def __init__(self, stack, size):
+        self.stack = stack
+        self.size = size
+        self.opened = 0
+        self.idle = asyncio.Queue()
+
+    async def get(self):
+        if self.idle.empty() and self.opened < self.size:
+            self.opened += 1
+            try:
+                return await self.stack.enter_async_context(smtp_session())
+            except Exception:
+                self.opened -= 1
+                raise
+        return await self.idle.get()
+
+    def put(self, server):
+        self.idle.put_nowait(server)
 
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=60))
-def send_email(file_path, story_title, receiver_email, error_message=None):
-    message = MIMEMultipart()
-    message['From'] = config['EMAIL']['sender']
+async def send_email(server, epub_data, story_title, receiver_email, error_message=None):
+    message = EmailMessage()
+    message['From'] = EMAIL.sender
     message['To'] = receiver_email
     message['Subject'] = story_title if not error_message else f'Error: {story_title}'
 
-    if file_path:
-        with open(file_path, 'rb') as attachment:
-            attach = MIMEBase('application', 'octet-stream')
-            attach.set_payload(attachment.read())
+    if error_message:
+        message.set_content(error_message)
 
-        encoders.encode_base64(attach)
-        attach.add_header('Content-Disposition', f'attachment; filename="{Path(file_path).name}"')
-        message.attach(attach)
+    if epub_data:
+        message.add_attachment(epub_data, maintype='application', subtype='epub+zip', filename=f'{sanitize_title(story_title)}.epub')
 
-    if error_message:
-        message.attach(MIMEText(error_message, 'plain'))
+    # Reconnect if the server dropped the session since the last email
+    try:
+        await server.noop()
+    except aiosmtplib.SMTPServerDisconnected:
+        await smtp_connect(server)
 
-    context = ssl.create_default_context()
-    with smtplib.SMTP(config['EMAIL']['smtp_server'], int(config['EMAIL']['smtp_port'])) as server:
-        server.ehlo()
-        server.starttls(context=context)
-        server.ehlo()
-        server.login(config['EMAIL']['username'], config['EMAIL']['password'])
-        server.sendmail(config['EMAIL']['sender'], receiver_email, message.as_string())
+    await server.send_message(message)
+
+async def send_notification(subject, message):
+    async with smtp_session() as server:
+        await send_email(server, None, subject, EMAIL.error_receiver, message)
+
+def describe_error(e):
+    # Failures inside a TaskGroup arrive wrapped in an ExceptionGroup; report the underlying errors
+    if isinstance(e, BaseExceptionGroup):
+        return "; ".join(describe_error(sub) for sub in e.exceptions)
+    return str(e)
 
 def job():
     try:
-        download_stories()
+        asyncio.run(download_stories())
     except Exception as e:
-        logging.error(f"Failed to download stories: {e}")
-        send_email(None, "Bot Error", config['EMAIL']['error_receiver'], f"Bot encountered an error: {e}")
+        error = describe_error(e)
+        logging.error(f"Failed to download stories: {error}")
+        asyncio.run(send_notification("Bot Error", f"Bot encountered an error: {error}"))
 
 # Schedule the bot to run hourly
 #schedule.every(1).hour.do(job)
 
 # Send start notification
-send_email(None, "Bot Started", config['EMAIL']['error_receiver'], "The bot has started.")
+asyncio.run(send_notification("Bot Started", "The bot has started."))
 
 job()
 